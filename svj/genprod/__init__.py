@@ -28,6 +28,9 @@ RUN_GRIDPACK_DIR = '/tmp/svj/rungridpack'
 RUN_FULLSIM_DIR = '/tmp/svj/runfullsim'
 SVJ_OUTPUT_DIR = '/tmp/svj/output'
 
+# Cache of generated param_card.dat files, keyed by the physics parameters
+PARAM_CARD_CACHE_DIR = osp.expanduser('~/.cache/svj_genprod/param_cards')
+
 # Assume running locally by default
 # This variable will be set to True if using the svjgenprod-batch script
 BATCH_MODE = False
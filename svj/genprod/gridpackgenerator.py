@@ -2,17 +2,331 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 
-import os, shutil, sys, glob, subprocess, logging
+import os, shutil, sys, glob, subprocess, logging, multiprocessing, re, hashlib, tarfile, tempfile
 import os.path as osp
-from string import Template
-from distutils.dir_util import copy_tree
 from time import strftime
+from contextlib import contextmanager
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # Python 2 without the `futures` backport; copies will run serially
+    ThreadPoolExecutor = None
 
 logger = logging.getLogger('root')
 
 import svj.genprod
 from .lhaIDs import lhaIDs
 
+# Buffer size for file I/O; the default 8 KiB is small for cvmfs/network filesystems
+_BUF = 1 << 18
+
+
+def _fast_copy(src, dst):
+    """
+    Copies the contents of file `src` to `dst`, keeping the data in the kernel
+    where possible: os.copy_file_range (a reflink on CoW filesystems), then
+    os.sendfile in 4 MiB chunks, and finally a buffered shutil.copyfileobj.
+    """
+    with open(src, 'rb', buffering=_BUF) as src_f:
+        with open(dst, 'wb', buffering=_BUF) as dst_f:
+            src_fd = src_f.fileno()
+            dst_fd = dst_f.fileno()
+            if hasattr(os, 'copy_file_range'):
+                try:
+                    copied = 0
+                    while True:
+                        n = os.copy_file_range(src_fd, dst_fd, 1 << 30)
+                        if n == 0: break
+                        copied += n
+                    # Some FUSE/network/pseudo filesystems report 0 bytes without
+                    # an error; only trust an empty copy for an empty source
+                    if copied or os.fstat(src_fd).st_size == 0: return
+                except OSError:
+                    pass
+                src_f.seek(0)
+                dst_f.seek(0)
+                dst_f.truncate()
+            if hasattr(os, 'sendfile'):
+                try:
+                    offset = 0
+                    while True:
+                        sent = os.sendfile(dst_fd, src_fd, offset, 4 << 20)
+                        if sent == 0: return
+                        offset += sent
+                except OSError:
+                    dst_f.seek(0)
+                    dst_f.truncate()
+            shutil.copyfileobj(src_f, dst_f, 1 << 20)
+
+
+def _n_copy_workers():
+    return min(32, multiprocessing.cpu_count() * 4)
+
+
+def _parallel_map(fn, *iterables):
+    """
+    Calls fn on the zipped iterables on a thread pool (serially if
+    concurrent.futures is not available), and returns the results as a list.
+    Exceptions raised in the workers are re-raised here.
+    """
+    if ThreadPoolExecutor is None:
+        return [fn(*args) for args in zip(*iterables)]
+    with ThreadPoolExecutor(max_workers=_n_copy_workers()) as executor:
+        return list(executor.map(fn, *iterables))
+
+
+def _parallel_copytree(src, dst):
+    """
+    Mirrors directory `src` into `dst`, copying the files with shutil.copy2
+    on a thread pool. The directory skeleton is created first in a single
+    walk, so the copy jobs themselves are independent of each other.
+    Symlinks (to files or directories) are recreated as symlinks.
+    """
+    srcs = []
+    dsts = []
+    for root, dirs, files in os.walk(src):
+        dst_root = osp.join(dst, osp.relpath(root, src))
+        if not osp.isdir(dst_root): os.makedirs(dst_root)
+        # os.walk lists symlinked dirs in `dirs` but does not descend into them
+        for name in dirs:
+            src_dir = osp.join(root, name)
+            if osp.islink(src_dir):
+                dst_dir = osp.join(dst_root, name)
+                if osp.lexists(dst_dir): os.remove(dst_dir)
+                os.symlink(os.readlink(src_dir), dst_dir)
+        for name in files:
+            src_file = osp.join(root, name)
+            dst_file = osp.join(dst_root, name)
+            if osp.islink(src_file):
+                if osp.lexists(dst_file): os.remove(dst_file)
+                os.symlink(os.readlink(src_file), dst_file)
+            else:
+                srcs.append(src_file)
+                dsts.append(dst_file)
+    _parallel_map(shutil.copy2, srcs, dsts)
+
+
+def _mtime(path):
+    """
+    Modification time used to invalidate the caches in this module; integer
+    nanoseconds where available (Python 3), float seconds otherwise.
+    """
+    stat = os.stat(path)
+    return getattr(stat, 'st_mtime_ns', stat.st_mtime)
+
+
+# Input card templates per template dir, as {dir: (mtime, [paths])}
+_TEMPLATE_GLOB_CACHE = {}
+
+def _list_dat(directory):
+    """
+    Returns the paths of the .dat files in `directory`. The listing is cached
+    and only redone when the mtime of the directory changes.
+    """
+    mtime = _mtime(directory)
+    cached = _TEMPLATE_GLOB_CACHE.get(directory)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    if hasattr(os, 'scandir'):
+        paths = [e.path for e in os.scandir(directory) if e.is_file() and e.name.endswith('.dat')]
+    else:
+        paths = [
+            osp.join(directory, name) for name in os.listdir(directory)
+            if name.endswith('.dat') and osp.isfile(osp.join(directory, name))
+            ]
+    _TEMPLATE_GLOB_CACHE[directory] = (mtime, paths)
+    return paths
+
+# `$name` placeholders in the model parameters.py template
+_PARAM_RE = re.compile(r'\$(\w+)')
+
+# Filled parameters.py contents, keyed by (template path, mtime, m_d, m_med)
+_PARAMETERS_PY_CACHE = {}
+
+def _render_parameters_py(template_file, m_d, m_med):
+    """
+    Returns the contents (bytes) of the model parameters.py template with
+    the dark quark and mediator masses filled in. Memoized per process.
+    """
+    key = (template_file, _mtime(template_file), m_d, m_med)
+    contents = _PARAMETERS_PY_CACHE.get(key)
+    if contents is None:
+        with open(template_file, 'rb', buffering=_BUF) as f:
+            template = f.read().decode()
+        subs = {'dark_quark_mass': str(m_d), 'mediator_mass': str(m_med)}
+        contents = _PARAM_RE.sub(lambda m: subs[m.group(1)], template).encode()
+        _PARAMETERS_PY_CACHE[key] = contents
+    return contents
+
+# Parsed input card templates, keyed by (path, mtime)
+_TEMPLATE_CACHE = {}
+# Filled input card templates, keyed by (path, mtime, model_name, total_events, lhaid)
+_RENDERED_CACHE = {}
+_TEMPLATE_FIELD_RE = re.compile(r'\{(\w+)\}')
+
+def _parse_template(template):
+    """
+    Splits the template text into a list of literal strings and 1-tuples
+    holding a field name, e.g. ['import model ', ('modelName',), '\n'].
+    Only plain `{field}` placeholders are supported (no format specs or
+    `{{` escapes), which is all the input card templates use.
+    """
+    segments = []
+    pos = 0
+    for match in _TEMPLATE_FIELD_RE.finditer(template):
+        segments.append(template[pos:match.start()])
+        segments.append((match.group(1),))
+        pos = match.end()
+    segments.append(template[pos:])
+    return segments
+
+def _get_template_segments(card_file, mtime):
+    key = (card_file, mtime)
+    segments = _TEMPLATE_CACHE.get(key)
+    if segments is None:
+        with open(card_file, 'r', buffering=_BUF) as f:
+            segments = _parse_template(f.read())
+        _TEMPLATE_CACHE[key] = segments
+    return segments
+
+def fill_template(card_file, model_name, total_events, lhaid):
+    """
+    Fills the {modelName}, {totalEvents} and {lhaid} placeholders in an
+    input card template. Both the parsed template and the filled result
+    are cached, so repeated gridpack builds do not re-read the file.
+    """
+    mtime = _mtime(card_file)
+    key = (card_file, mtime, model_name, total_events, lhaid)
+    if key in _RENDERED_CACHE:
+        return _RENDERED_CACHE[key]
+    values = dict(modelName=model_name, totalEvents=total_events, lhaid=lhaid)
+    contents = ''.join(
+        s if isinstance(s, str) else str(values[s[0]])
+        for s in _get_template_segments(card_file, mtime)
+        )
+    _RENDERED_CACHE[key] = contents
+    return contents
+
+
+def _tar_directory(out_path, root_dir, base_dir):
+    """
+    Writes `root_dir/base_dir` to the tarball `out_path`, with paths in the
+    tarball starting at `base_dir` (like shutil.make_archive). The entries are
+    collected up front and added non-recursively, and the output file is
+    opened with a 1 MiB buffer; tarfile otherwise writes in 10 KiB records.
+    """
+    entries = []
+    for root, dirs, files in os.walk(osp.join(root_dir, base_dir)):
+        dirs.sort()
+        entries.append(root)
+        # os.walk lists symlinked dirs in `dirs` but does not descend into them;
+        # add them as (symlink) members like shutil.make_archive does
+        names = [name for name in dirs if osp.islink(osp.join(root, name))] + files
+        entries.extend(osp.join(root, name) for name in sorted(names))
+    # Default tarfile format: ustar cannot store large uids/gids (e.g. AD-mapped accounts)
+    with open(out_path, 'wb', buffering=1 << 20) as f:
+        with tarfile.open(fileobj=f, mode='w') as tar:
+            for path in entries:
+                tar.add(path, arcname=osp.relpath(path, root_dir), recursive=False)
+    return out_path
+
+
+# Digests of model .py files, keyed by (path, mtime, size)
+_MODEL_FILE_DIGEST_CACHE = {}
+
+def _model_py_digests(model_dir):
+    """
+    Returns the names and content digests of all .py files in a UFO model
+    dir, interleaved and sorted by name: every one of them can be imported
+    while ParamCardWriter runs (parameters, particles, object_library, ...).
+    Digests are cached by mtime and size, so unchanged files are not re-read.
+    """
+    digests = []
+    for name in sorted(os.listdir(model_dir)):
+        path = osp.join(model_dir, name)
+        if not name.endswith('.py') or not osp.isfile(path): continue
+        key = (path, _mtime(path), osp.getsize(path))
+        digest = _MODEL_FILE_DIGEST_CACHE.get(key)
+        if digest is None:
+            with open(path, 'rb', buffering=_BUF) as f:
+                digest = hashlib.md5(f.read()).digest()
+            _MODEL_FILE_DIGEST_CACHE[key] = digest
+        digests.extend([name.encode(), digest])
+    return digests
+
+
+# Generated param_card.dat contents, keyed by _param_card_key
+_PARAM_CARD_CACHE = {}
+
+def _param_card_key(params, *contents):
+    """
+    Short hex digest identifying a set of physics parameters, plus the
+    contents (bytes, or digests thereof) of the model files the param card
+    is generated from, so that edits to those files invalidate cached cards.
+    """
+    if hasattr(hashlib, 'blake2b'):
+        h = hashlib.blake2b(digest_size=16)
+    else:
+        h = hashlib.md5()
+    h.update(repr(params).encode())
+    for content in contents:
+        h.update('{0}:'.format(len(content)).encode())
+        h.update(content)
+    return h.hexdigest()
+
+
+def _load_module_from_file(path, name):
+    """Executes the python file at `path` as a module, without touching sys.path"""
+    try:
+        import importlib.util
+    except ImportError:
+        import imp
+        return imp.load_source(name, path)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# Loaded write_param_card modules, keyed by path
+_PARAM_WRITER_CACHE = {}
+
+def _get_param_card_writer_module(path):
+    """
+    Returns the write_param_card module at `path`, loading it only once per
+    process. Should be called inside _model_dir_on_path, since the module
+    imports function_library by bare name.
+    """
+    module = _PARAM_WRITER_CACHE.get(path)
+    if module is None:
+        name = 'write_param_card_' + hashlib.md5(path.encode()).hexdigest()[:12]
+        module = _load_module_from_file(path, name)
+        _PARAM_WRITER_CACHE[path] = module
+    return module
+
+
+@contextmanager
+def _model_dir_on_path(model_dir):
+    """
+    The UFO model files import each other by bare name (e.g. `from parameters
+    import all_parameters`), so the model dir needs to be on sys.path while
+    they run. Puts it there only for the duration of the context, and drops
+    the model modules imported in the meantime from sys.modules, so that a
+    model loaded later in the same process does not pick up stale `parameters`.
+    Other modules imported along the way (e.g. cmath) are left alone.
+    """
+    modules_before = set(sys.modules)
+    sys.path.insert(0, model_dir)
+    try:
+        yield
+    finally:
+        sys.path.remove(model_dir)
+        model_dir_prefix = osp.join(osp.abspath(model_dir), '')
+        for name in set(sys.modules) - modules_before:
+            module_file = getattr(sys.modules[name], '__file__', None)
+            if module_file and osp.abspath(module_file).startswith(model_dir_prefix):
+                del sys.modules[name]
+
 
 #____________________________________________________________________
 class GridpackGenerator(object):
@@ -93,25 +407,62 @@ class GridpackGenerator(object):
             return
         # Copy model files to new directory and change relevant parameters according to config
         logger.info('Copying template model: {0} to {1}'.format(self.template_model_dir, self.new_model_dir))
-        copy_tree(self.template_model_dir, self.new_model_dir)
-        # Read the parameters file (containing the dark particle masses) in the new model directory
-        with open(os.path.join(self.new_model_dir, 'parameters.py'), 'r+') as f:
-            old_params = Template(f.read())
-            # Fill placeholders with values chosen by user
-            new_params = old_params.substitute(dark_quark_mass=str(self.m_d), mediator_mass=str(self.m_med))
-            f.seek(0)
-            f.truncate()
+        _parallel_copytree(self.template_model_dir, self.new_model_dir)
+        # Overwrite the parameters file (containing the dark particle masses) with the filled template
+        new_params = _render_parameters_py(
+            osp.join(self.template_model_dir, 'parameters.py'), self.m_d, self.m_med
+            )
+        with open(osp.join(self.new_model_dir, 'parameters.py'), 'wb', buffering=_BUF) as f:
             f.write(new_params)
         logger.info('New parameters written in model files!')
 
     def write_param_card(self):
-        logger.info('Writing param_card.dat')
-        # Use the write_param_card.py module that is in the newly created model_dir
-        sys.path.append(self.new_model_dir)
-        from write_param_card import ParamCardWriter
         param_card_file = osp.join(self.new_model_dir, 'param_card.dat')
-        ParamCardWriter(param_card_file, generic=True)
-        logger.info('Done writing param_card.dat')
+        # Key on the model files the writer actually runs against, which may be
+        # older than the template if create_model_dir did not re-copy them
+        key = _param_card_key(
+            (self.template_model_dir, self.channel, self.m_med, self.m_d, self.r_inv, self.alpha_d),
+            *_model_py_digests(self.new_model_dir)
+            )
+        contents = _PARAM_CARD_CACHE.get(key)
+        if contents is not None:
+            logger.info('Using param_card.dat generated earlier in this process')
+            with open(param_card_file, 'wb', buffering=_BUF) as f:
+                f.write(contents)
+            return
+
+        cache_dir = svj.genprod.PARAM_CARD_CACHE_DIR
+        cached_card = osp.join(cache_dir, key + '.dat')
+        if osp.isfile(cached_card):
+            logger.info('Using cached param_card.dat {0}'.format(cached_card))
+            shutil.copyfile(cached_card, param_card_file)
+        else:
+            logger.info('Writing param_card.dat')
+            # Use the write_param_card.py module that is in the newly created model_dir
+            with _model_dir_on_path(self.new_model_dir):
+                write_param_card = _get_param_card_writer_module(
+                    osp.join(self.new_model_dir, 'write_param_card.py')
+                    )
+                write_param_card.ParamCardWriter(param_card_file, generic=True)
+            logger.info('Done writing param_card.dat')
+
+            # Store in the cache. Write to a uniquely named temp file and rename it, so
+            # concurrent jobs (possibly on other hosts sharing the home dir) never see
+            # a partial card
+            tmp_card = None
+            try:
+                if not osp.isdir(cache_dir): os.makedirs(cache_dir)
+                fd, tmp_card = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+                with os.fdopen(fd, 'wb') as tmp_f:
+                    with open(param_card_file, 'rb', buffering=_BUF) as f:
+                        shutil.copyfileobj(f, tmp_f, 1 << 20)
+                os.rename(tmp_card, cached_card)
+            except (IOError, OSError) as e:
+                logger.warning('Could not cache param_card.dat in {0}: {1}'.format(cache_dir, e))
+                if tmp_card is not None and osp.lexists(tmp_card): os.remove(tmp_card)
+
+        with open(param_card_file, 'rb', buffering=_BUF) as f:
+            _PARAM_CARD_CACHE[key] = f.read()
 
     def setup_input_dir(self):
         self.new_input_dir = osp.join(self.mg_input_dir, self.model_name + '_input')
@@ -119,35 +470,32 @@ class GridpackGenerator(object):
         logger.info('Getting templates from mg_input_template_dir: {0}'.format(self.template_input_dir))
         svj.core.utils.create_directory(self.new_input_dir, force=self.force_renew_input_dir)
 
-        def fill_template(card_file, model_name, total_events, lhaid):
-            with open(card_file, 'r+') as f:
-                template = f.read()
-            return template.format(modelName=model_name, totalEvents=total_events, lhaid=lhaid)
+        # Loop invariants
+        model_name = self.model_name
+        n_events = self.n_events
+        lhaid = lhaIDs[self.year]
+        new_input_dir = self.new_input_dir
 
-        for template in glob.glob(osp.join(self.template_input_dir, '*.dat')):
-            out_file = osp.join(
-                self.new_input_dir,
-                osp.basename(template).replace('modelname', self.model_name)
-                )
+        for template in _list_dat(self.template_input_dir):
+            out_file = osp.join(new_input_dir, osp.basename(template).replace('modelname', model_name))
             out_contents = fill_template(
                 card_file = template,
-                # model_name = 'DMsimp_SVJ_s_spin1' if template.endswith('extramodels.dat') else self.model_name,
-                model_name = self.model_name,
-                total_events = self.n_events,
-                lhaid = lhaIDs[self.year]
+                # model_name = 'DMsimp_SVJ_s_spin1' if template.endswith('extramodels.dat') else model_name,
+                model_name = model_name,
+                total_events = n_events,
+                lhaid = lhaid
                 )
-            logger.info('Writing formatted template to {0}'.format(out_file))
-            with open(out_file, 'w') as f:
+            logger.info('Writing formatted template to %s', out_file)
+            with open(out_file, 'w', buffering=_BUF) as f:
                 f.write(out_contents)
 
         logger.info('Tarring up input_cards_dir')
-        shutil.make_archive(
-            base_name = osp.join(self.new_input_dir, self.model_name),
-            format =  'tar',
+        tarball = _tar_directory(
+            out_path = osp.join(self.new_input_dir, self.model_name + '.tar'),
             root_dir = self.mg_model_dir,
-            base_dir = self.model_name,
-            logger = logger
+            base_dir = self.model_name
             )
+        logger.info('Created {0}'.format(tarball))
         logger.info('Inputs directory finished')
 
 
@@ -165,20 +513,6 @@ class GridpackGenerator(object):
             # MadGraph wants a relative path to the input cards dir
             input_cards_dir_relative = osp.relpath(self.new_input_dir, self.mg_genprod_dir)
 
-            # Unset some environment variables that otherwise crash MG compilation
-            env = os.environ.copy()
-            to_unset = [
-                'LD_LIBRARY_PATH',
-                'FC',
-                'COMPILER_PATH',
-                'PYTHONPATH',
-                'CC',
-                'COMPILER_PATH',
-                'CXX'
-                ]
-            for var in to_unset:
-                if var in env: del env[var]
-
             cmd = [
                     'source /cvmfs/cms.cern.ch/cmsset_default.sh',
                     ['bash',
@@ -197,11 +531,11 @@ class GridpackGenerator(object):
             except subprocess.CalledProcessError:
                 # Try to display the log file if there is one before throwing
                 if osp.isfile(self.logfile):
-                    with open(self.logfile, 'r') as f:
-                        logger.info(
-                            'Contents of {0}:\n{1}'
-                            .format(self.logfile, f.read())
-                            )
+                    logger.info('Contents of {0}:'.format(self.logfile))
+                    # Stream in ~_BUF chunks of whole lines; MadGraph logs can be many MB
+                    with open(self.logfile, 'rb', buffering=_BUF) as f:
+                        for lines in iter(lambda: f.readlines(_BUF), []):
+                            logger.info(b''.join(lines).decode('utf-8', 'replace').rstrip('\n'))
                 else:
                     logger.warning('File {0} does not exist'.format(self.logfile))
                 raise
@@ -243,19 +577,21 @@ class GridpackGenerator(object):
     def _transfer_to_output(self, move=False, output_dir=None, dry=False):
         srcs = self._get_output_files_and_dirs()
         output_dir = self._make_output_directory(output_dir)
-        for src in srcs:
-            dst = osp.join(output_dir, osp.basename(src))
+        dsts = [osp.join(output_dir, osp.basename(src)) for src in srcs]
+        for src, dst in zip(srcs, dsts):
             if move:
                 logger.info('Moving {0} ==> {1}'.format(src, dst))
+                # shutil.move is a plain rename if src and dst are on the same filesystem
                 if not dry: shutil.move(src, dst)
             else:
                 logger.info('Copying {0} ==> {1}'.format(src, dst))
-                if not dry: shutil.copyfile(src, dst)
             # Slightly hacky: assuming there is one log file, point to the moved/copied
             # log file after this function is called
             if src.endswith('.log'):
                 logger.info('Log file now in {0}'.format(dst))
                 self.logfile = osp.abspath(dst)
+        if not move and not dry:
+            _parallel_map(_fast_copy, srcs, dsts)
 
 
     def copy_to_output(self, output_dir=None, dry=False):